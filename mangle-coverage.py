@@ -3,70 +3,105 @@
 # pylint: disable-msg=invalid-name
 # pylint: disable-msg=redefined-outer-name
 
-from collections import namedtuple
-from pathlib import Path
-import networkx as nx
+from bisect import bisect_right
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+import mmap
 import os
 import re
-import subprocess
 import sys
 
 FnRecord = namedtuple("FnRecord", ["name", "start", "end"])
+SourceTree = namedtuple("SourceTree", ["test_files", "callgraph_files", "lib_files"])
 
-def is_fnda_line_for_fn(line, fn):
-    """ Is this a FNDA line describing a given function? """
+Context = namedtuple("Context", ["tested", "static", "tested_private", "callgraphs"])
 
-    return line.startswith("FNDA:") and line.endswith(",%s" % fn)
+# How many records to hand to a worker process at once
+RECORD_CHUNK_SIZE = 32
 
-def is_line_in_fn(line, start, end):
-    """ If this is a DA line, does the line number fall within the range
-        [start, end]?
-    """
+# How many rendered records to collect before writing them out
+WRITE_BATCH_SIZE = 256
+
+# The Context a worker process uses for processing records, set by init_worker
+context = None
 
-    if not line.startswith("DA:"):
-        return False
+# Matches an edge line in a callgraph file, capturing the source and target
+# function names.  Some names have <file>: at the beginning, which is skipped
+# over here so it doesn't end up in the captured name.
+EDGE_RE = re.compile(rb'(?m)^edge:[^\n]*?'
+                     rb'sourcename: "(?:[^":\n]*:)?([^":\n]+)[^"\n]*" '
+                     rb'targetname: "(?:[^":\n]*:)?([^":\n]+)[^"\n]*"')
 
-    line = line.removeprefix("DA:")
-    (line_no, _) = line.split(",")
+# Matches a line in a C source file that begins with "static", capturing that
+# line and the one after it.  The following line is captured with a lookahead
+# so it can itself match if it also begins with "static".
+STATIC_RE = re.compile(rb'(?m)^(static[^\n]*)(?:\n(?=([^\n]*)))?')
 
-    return int(line_no) >= start and (end is None or int(line_no) <= end)
+# Every byte that can't be part of a C identifier, for use with bytes.translate
+NOT_IDENTIFIER_BYTES = bytes(b for b in range(256)
+                             if not (b < 128 and (chr(b).isalnum() or chr(b) == "_")))
 
-def is_static_fn(lst, fn):
-    """ Is the given function static? """
+def private_fns_with_tested_public(tested):
+    """ Return the set of names of private functions (ones that start with
+        "pcmk__") that have a public version (one that starts with "pcmk_")
+        in the set of tested functions.
+    """
 
-    return fn in lst
+    return frozenset("pcmk__" + fn[5:] for fn in tested if fn.startswith("pcmk_"))
 
-def private_fn_with_tested_public(lst, fn):
-    """ Is this a private function (one that starts with "pcmk__") and if so,
-        is there a public version (one that starts with "pcmk_") in the list
-        of tested functions?
+def scan_tree(top="."):
+    """ Walk the source tree once, returning a SourceTree listing the unit test
+        source files, the callgraph files generated by gcc (.ci files, with the
+        current source directory removed from the front of each), and the C
+        source and header files in the lib directory.
     """
 
-    return fn.startswith("pcmk__") and fn.replace("pcmk__", "pcmk_", 1) in lst
+    test_files = []
+    cg_files = []
+    lib_files = []
 
-def source_file(record):
-    """ Return the source file described by a given record """
+    for (dirpath, _, filenames) in os.walk(top):
+        for name in filenames:
+            path = os.path.normpath(os.path.join(dirpath, name))
 
-    for line in record:
-        if not line.startswith("SF:"):
-            continue
+            if name.endswith("_test.c"):
+                test_files.append(path)
+
+            if name.endswith(".ci"):
+                s = os.path.abspath(path)
+
+                # Weed out stuff we don't care about:
+                # Callgraphs for unit test files
+                if name.endswith("_test.ci"):
+                    continue
+
+                # Callgraphs for the specially built test versions of libraries - the regular
+                # ones will work fine for checking call chains
+                if "_test_la-" in name:
+                    continue
+
+                # Callgraphs in /.libs/ (I think)
+                if "/.libs/" in s:
+                    continue
 
-        return line.removeprefix("SF:")
+                cg_files.append(remove_source_dir(s))
 
-    return None
+            elif name.endswith((".c", ".h")) and path.startswith("lib" + os.sep):
+                lib_files.append(path)
 
-def tested_fns():
-    """ Return a list of all functions which have a unit test.  Luckily, we
+    return SourceTree(test_files, cg_files, lib_files)
+
+def tested_fns(test_files):
+    """ Return a set of all functions which have a unit test.  Luckily, we
         give the test files a name that matches the function.
     """
 
     fns = []
 
-    p = Path(".")
-    test_files = list(p.glob("**/*_test.c"))
-
     for f in test_files:
-        fns.append(f.name.removesuffix("_test.c"))
+        fns.append(sys.intern(os.path.basename(f).removesuffix("_test.c")))
 
     # Some functions have unit tests in a file that doesn't match their name.
     # This commonly happens with things like case-sensitive vs. case-insensitive
@@ -80,212 +115,356 @@ def tested_fns():
                 "pcmk_rc_name",
                 "pcmk_rc_str"])
 
-    return sorted(fns)
+    return frozenset(fns)
 
-def fns_in_record(record):
-    """ Given a record, return a list of (function, first line, last line) tuples.
-        If the function is the last in the record, last line will be None.
+class Record:
+    """ A single record from an lcov output file.  In addition to the lines
+        themselves, this keeps track of where the interesting lines are so
+        we don't have to keep rescanning the whole record for them.
     """
 
-    tuples = []
-
-    # First pass - generate a list where all the last lines are set to None.
-    for line in record:
-        if not line.startswith("FN:"):
-            continue
-
-        line = line.removeprefix("FN:")
-        (line_no, fn) = line.split(",")
-
-        tuples.append(FnRecord(fn, int(line_no), None))
-
-    # Second pass - iterate over the tuples list and fix up the last lines.
-    for i in range(0, len(tuples) - 1):
-        tuples[i] = tuples[i]._replace(end=tuples[i+1].start - 1)
-
-    return tuples
+    def __init__(self, lines):
+        self.lines = lines
+        self.source_file = None
+
+        # Function name -> index of its FNDA line
+        self.fnda_by_name = {}
+        # Function name -> whether it was executed
+        self.fn_exec = {}
+        # A list of FnRecord tuples, in the order they appear in the record
+        self.fn_ranges = []
+        # A list of (index, line number, execution count) for each DA line.  The
+        # count is left as a string, since all we care about is whether it's "0".
+        self.da_index = []
+
+        # Most lines in a record are DA lines, so avoid as much attribute and
+        # global lookup in this loop as possible.
+        _int = int
+        da_append = self.da_index.append
+
+        for (i, line) in enumerate(lines):
+            prefix = line[:3]
+
+            if prefix == "DA:":
+                (line_no, _, cnt) = line[3:].partition(",")
+                da_append((i, _int(line_no), cnt))
+
+            elif prefix == "FN:":
+                (line_no, _, fn) = line[3:].partition(",")
+                fn = sys.intern(fn)
+                self.fn_ranges.append(FnRecord(fn, _int(line_no), None))
+
+            elif line[:5] == "FNDA:":
+                (cnt, _, fn) = line[5:].partition(",")
+                fn = sys.intern(fn)
+                # Only the first FNDA line for a function counts.
+                if fn not in self.fnda_by_name:
+                    self.fnda_by_name[fn] = i
+                    self.fn_exec[fn] = cnt != "0"
+
+            elif prefix == "SF:" and self.source_file is None:
+                self.source_file = line[3:]
+
+        # Now that we've seen all the functions, fix up the last lines.  If the
+        # function is the last in the record, last line will be None.
+        for i in range(0, len(self.fn_ranges) - 1):
+            self.fn_ranges[i] = self.fn_ranges[i]._replace(end=self.fn_ranges[i+1].start - 1)
 
 def fn_executed(record, fn):
     """ Given a record and a function name, return whether that function was
         actually executed.
     """
 
-    for line in record:
-        if not is_fnda_line_for_fn(line, fn):
-            continue
-
-        line = line.removeprefix("FNDA:")
-        (cnt, _) = line.split(",")
-
-        return cnt != "0"
-
-    return False
+    return record.fn_exec.get(fn, False)
 
-def recordize_info_file():
-    """ Split an lcov output file into a list of records.  A record is simply
-        a list of lines, nothing fancy.
+def iter_records(file_name):
+    """ Split an lcov output file into records, yielding each one as it is read
+        so the whole file never has to be held in memory at once.  A record is
+        simply a list of lines, nothing fancy.
     """
 
-    records = []
-
-    with open(sys.argv[1]) as lcov:
+    with open(file_name, encoding="utf-8", buffering=1<<20) as lcov:
         this_record = []
 
         for line in lcov:
             line = line.strip()
 
             if line == "end_of_record":
-                records.append(this_record)
+                yield this_record
                 this_record = []
                 continue
 
             this_record.append(line)
 
-    return records
+def static_fn_from_line(line):
+    """ Given a line that could be part of a static function declaration (either
+        the line starting with "static" or the one following it) as bytes, return
+        the name of the function being declared or None.
+    """
+
+    # If the line doesn't contain an opening paren, it's definitely not
+    # a function declaration.
+    if b"(" not in line:
+        return None
+
+    # If the line contains an equals, it's probably a variable declaration.
+    if b"=" in line:
+        return None
 
-def static_fns():
-    """ Return a list of all static functions """
+    # Drop everything from the opening paren to the end of line.  This gets
+    # rid of all the function parameters.
+    line = line.split(b"(")[0]
 
-    # This is lame, lame, lame but I don't feel like writing the equivalent
-    # in python.
+    # Having done that, we can now drop everything up through the rightmost
+    # space.  This catches the couple cases where we have the "static void"
+    # or whatever type on the same line as the function name.
+    line = line.split(b" ")[-1]
+
+    # Strip out anything that's not valid in a C identifier.  Whatever's left
+    # is plain ASCII.
+    line = line.translate(None, NOT_IDENTIFIER_BYTES)
+
+    return line.decode("ascii") or None
+
+def static_fns_in_file(file_name):
+    """ Return a list of all static functions declared in a single source file """
+
+    fns = []
+
+    with open(file_name, "rb") as f:
+        data = f.read()
+
+    # Look at every line that begins with "static", plus the line after it in
+    # case the return type and function name are on separate lines.
+    for match in STATIC_RE.finditer(data):
+        for line in match.groups():
+            if line is None:
+                continue
+
+            fn = static_fn_from_line(line)
+            if fn:
+                fns.append(fn)
+
+    return fns
+
+def static_fns(lib_files):
+    """ Return a set of all static functions declared in the given files """
 
     fns = []
 
-    # grep all the source files for lines that begin with "static".
     # Note that we only care about static functions in the lib directory
     # for now.  Static functions in include/ are not really static in
     # the same sense and can have unit tests written.
+    with ProcessPoolExecutor() as executor:
+        for lst in executor.map(static_fns_in_file, lib_files, chunksize=64):
+            # Strings don't stay interned on their way back from the worker
+            # processes, so do that here.
+            fns.extend(sys.intern(fn) for fn in lst)
 
-    try:
-        output = subprocess.check_output("find lib -name '*.[ch]' | xargs grep -h -A 1 ^static",
-                                         shell=True)
-    except subprocess.CalledProcessError:
-        return fns
+    return frozenset(fns)
 
-    for line in output.decode().split("\n"):
-        # If the line doesn't contain an opening paren, it's definitely not
-        # a function declaration.
-        if "(" not in line:
-            continue
+def nothing_calls_fn(callgraph, candidates, fn):
+    for c in candidates:
+        if c.name not in callgraph or fn not in callgraph:
+            # I don't know what's up with these, so just ignore them for now.
+            if c.name == "pcmk__starts_with" and fn in ["ends_with", "pcmk__str_hash", \
+                                                        "pcmk__strcase_equal", "pcmk__strcase_hash", \
+                                                        "copy_str_table_entry"]:
+                continue
 
-        # If the line contains an equals, it's probably a variable declaration.
-        if "=" in line:
-            continue
+            if c.name == "pe__cmp_rsc_priority" and fn == "resource_node_score":
+                continue
 
-        # Drop everything from the opening paren to the end of line.  This gets
-        # rid of all the function parameters.
-        line = line.split("(")[0]
+            raise KeyError("Either %s or %s is not in the callgraph" % (c.name, fn))
 
-        # Having done that, we can now drop everything up through the rightmost
-        # space.  This catches the couple cases where we have the "static void"
-        # or whatever type on the same line as the function name.
-        line = line.split(" ")[-1]
+        if callgraph.can_reach(c.name, fn):
+            return False
 
-        # Strip out anything that's not valid in a C identifier.
-        line = re.sub(r'[\W]', '', line)
+    return True
 
-        if not line:
-            continue
+def render_record(record, erased):
+    """ Convert a record into a string that can be printed out, removing the
+        coverage data for every function in erased (a list of FnRecords) along
+        the way.
+    """
 
-        fns.append(line)
+    lines = []
+    executed_lines = 0
 
-    return fns
+    # Index of FNDA line -> name, for the erased functions
+    fnda = {record.fnda_by_name[fr.name]: fr.name for fr in erased}
 
-def erase_function_from_record(record, fr):
-    """ Remove a function from the given coverage record """
+    # lcov sorts FN lines by line number, so the erased functions can be searched
+    # by bisecting over their first lines to find which one (if any) a given DA
+    # line falls within.
+    erased = sorted(erased, key=lambda fr: fr.start)
+    starts = [fr.start for fr in erased]
 
-    new_lines = []
-    executed_lines = 0
+    # The DA lines are indexed in the order they appear in the record, so just
+    # keep track of the next one we're going to see.
+    da_index = iter(record.da_index)
+    next_da = next(da_index, None)
 
-    for line in record:
-        # Reset the execution count for the function to 0.
-        if is_fnda_line_for_fn(line, fr.name):
-            new_lines.append("FNDA:0,%s" % fr.name)
+    for (i, line) in enumerate(record.lines):
+        # Reset the execution count for each line in an erased function to 0.
+        if next_da is not None and next_da[0] == i:
+            (_, line_no, cnt) = next_da
+            next_da = next(da_index, None)
 
-        # Remove the function from the total number of functions hit.
-        elif line.startswith("FNH:"):
-            (_, cnt) = line.split(":")
-            new_lines.append("FNH:%d" % (int(cnt) - 1))
+            idx = bisect_right(starts, line_no) - 1
+            if idx >= 0 and (erased[idx].end is None or line_no <= erased[idx].end):
+                lines.append("DA:%d,0" % line_no)
 
-        # Reset the exection count for each line in the function to 0.
-        elif is_line_in_fn(line, fr.start, fr.end):
-            line = line.removeprefix("DA:")
-            (line_no, cnt) = line.split(",")
-            new_lines.append("DA:%s,0" % line_no)
+                if cnt != "0":
+                    executed_lines += 1
 
-            if cnt != "0":
-                executed_lines += 1
+                continue
+
+        # Reset the execution count for each erased function to 0.
+        elif i in fnda:
+            line = "FNDA:0,%s" % fnda[i]
 
-        # Remove the count of the function's executed lines from the
+        # Remove the erased functions from the total number of functions hit.
+        elif line[:4] == "FNH:":
+            line = "FNH:%d" % (int(line[4:]) - len(erased))
+
+        # Remove the count of the erased functions' executed lines from the
         # total.
-        elif line.startswith("LH:"):
-            (_, cnt) = line.split(":")
-            new_lines.append("LH:%d" % (int(cnt) - executed_lines))
+        elif line[:3] == "LH:":
+            line = "LH:%d" % (int(line[3:]) - executed_lines)
 
-        else:
-            new_lines.append(line)
+        lines.append(line)
 
-    return new_lines
+    lines.append("end_of_record\n")
+    return "\n".join(lines)
 
-def nothing_calls_fn(callgraph, candidates, fn):
-    retval = True
+class CallGraph:
+    """ A directed graph from function to all functions that it calls """
 
-    for c in candidates:
-        try:
-            if nx.has_path(callgraph, c.name, fn):
-                retval = False
-                break
-        except nx.NodeNotFound as e:
-            # I don't know what's up with these, so just ignore them for now.
-            if c.name == "pcmk__starts_with" and fn in ["ends_with", "pcmk__str_hash", \
-                                                        "pcmk__strcase_equal", "pcmk__strcase_hash", \
-                                                        "copy_str_table_entry"]:
-                continue
+    def __init__(self):
+        # Function name -> list of functions it calls.  Every function in the
+        # graph has an entry, even if it doesn't call anything.
+        self.adj = {}
 
-            if c.name == "pe__cmp_rsc_priority" and fn == "resource_node_score":
+        # Function name -> the strongly connected component it belongs to, and
+        # component -> set of all components reachable from it.  These are
+        # computed the first time can_reach is called.
+        self._scc = None
+        self._reach = None
+
+    def __contains__(self, fn):
+        return fn in self.adj
+
+    def add_edge(self, src, dest):
+        self.adj.setdefault(src, []).append(dest)
+        self.adj.setdefault(dest, [])
+
+        self._scc = None
+        self._reach = None
+
+    def _build_reach(self):
+        """ Find the strongly connected components of the graph with Tarjan's
+            algorithm and compute which components can reach which others.
+            Tarjan's algorithm finishes a component only after every component
+            reachable from it, so each component's reach can be built from the
+            ones already finished.
+        """
+
+        self._scc = {}
+        self._reach = []
+
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+
+        for root in self.adj:
+            if root in index:
                 continue
 
-            raise e
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self.adj[root]))]
+
+            while work:
+                (v, children) = work[-1]
+
+                for w in children:
+                    if w not in index:
+                        index[w] = low[w] = len(index)
+                        stack.append(w)
+                        on_stack.add(w)
+                        work.append((w, iter(self.adj[w])))
+                        break
+
+                    if w in on_stack:
+                        low[v] = min(low[v], index[w])
+                else:
+                    work.pop()
+                    if work:
+                        u = work[-1][0]
+                        low[u] = min(low[u], low[v])
+
+                    if low[v] != index[v]:
+                        continue
+
+                    # v is the root of a component, which is everything above it
+                    # on the stack.
+                    n = len(self._reach)
+                    members = []
+
+                    while True:
+                        w = stack.pop()
+                        on_stack.remove(w)
+                        self._scc[w] = n
+                        members.append(w)
+
+                        if w == v:
+                            break
+
+                    reach = {n}
 
-    return retval
+                    for w in members:
+                        for x in self.adj[w]:
+                            if self._scc[x] != n:
+                                reach |= self._reach[self._scc[x]]
 
-def render_record(record):
-    """ Convert a record into a string that can be printed out """
+                    self._reach.append(reach)
 
-    return "\n".join(record + ["end_of_record"])
+    def can_reach(self, src, dest):
+        """ Can the function src reach the function dest?  A function can always
+            reach itself.
+        """
 
+        if self._reach is None:
+            self._build_reach()
+
+        return self._scc[dest] in self._reach[self._scc[src]]
+
+@lru_cache(maxsize=None)
 def build_call_graph(file_name):
     """ Build a directed graph from function to all functions that it calls.
         Note that these graphs only cover calls within a single source file.
     """
 
-    G = nx.DiGraph()
-    regex = re.compile(r"sourcename: \"([^\"]+)\" targetname: \"([^\"]+)\"")
-
-    with open(file_name) as f:
-        for line in f:
-            if not line.startswith("edge:"):
-                continue
-
-            match = re.search(regex, line)
-            if not match:
-                continue
-
-            src = match.group(1)
-            dest = match.group(2)
+    G = CallGraph()
 
-            # Don't know what these are, but don't care
-            if match.group(2) == "__indirect_call":
-                continue
+    with open(file_name, "rb") as f:
+        # mmap can't map an empty file.
+        if os.fstat(f.fileno()).st_size == 0:
+            return G
 
-            # Some keys have <file>: at the beginning, so trim that off.
-            if ":" in src:
-                src = src.split(":")[1]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for match in EDGE_RE.finditer(mm):
+                src = sys.intern(match.group(1).decode())
+                dest = sys.intern(match.group(2).decode())
 
-            if ":" in dest:
-                dest = dest.split(":")[1]
+                # Don't know what these are, but don't care
+                if dest == "__indirect_call":
+                    continue
 
-            G.add_edge(src, dest)
+                G.add_edge(src, dest)
 
     return G
 
@@ -296,119 +475,160 @@ def remove_source_dir(s):
 
     return s.removeprefix(os.getcwd() + "/")
 
-def callgraph_files():
-    """ Return a list of callgraph files generated by gcc (.ci files) as strings, with the
-        current source directory removed from the front of each
+def index_callgraph_files(callgraphs):
+    """ Given a list of callgraph files, return a dict mapping (directory, source file
+        name minus extension) to the callgraph file for that source file.
     """
 
-    lst = []
-    p = Path(".")
+    # Source file names are something like "lib/services/systemd.c", but the callgraph
+    # names are something like "lib/services/libcrmservice_la-services.ci".  The same
+    # source file could also exist in multiple directories.
+    #
+    # So, we need to find a callgraph file that ends with the same filename, but also
+    # exists in the right subdirectory.  The presence of the compiled object in the file
+    # name makes this all more annoying than it needs to be.
 
-    # Weed out stuff we don't care about:
-    for fo in list(p.glob("**/*.ci")):
-        s = str(fo.resolve())
+    index = {}
 
-        # Callgraphs for unit test files
-        if fo.name.endswith("_test.ci"):
-            continue
+    for f in callgraphs:
+        # Split the directory off from the callgraph file.
+        (cgPath, cgFileName) = os.path.split(f)
 
-        # Callgraphs for the specially built test versions of libraries - the regular
-        # ones will work fine for checking call chains
-        if "_test_la-" in fo.name:
+        if not cgFileName.endswith(".ci"):
             continue
 
-        # Callgraphs in /.libs/ (I think)
-        if "/.libs/" in s:
-            continue
+        # The source file name could itself contain dashes, so every piece of the
+        # callgraph name following a dash is a possible match.  If more than one
+        # callgraph file matches, the first one wins.
+        base = cgFileName.removesuffix(".ci")
+        pos = base.find("-")
 
-        lst.append(remove_source_dir(s))
+        while pos != -1:
+            index.setdefault((cgPath, base[pos+1:]), f)
+            pos = base.find("-", pos+1)
 
-    return lst
+    return index
 
-def find_callgraph_file(callgraphs, file_name):
-    """ Given a list of callgraph files and a source filename, return the callgraph
+def find_callgraph_file(index, file_name):
+    """ Given an index of callgraph files and a source filename, return the callgraph
         file that matches or None if no callgraph is found.
     """
 
-    # file_name is something like "lib/services/systemd.c", but the callgraph names are
-    # something like "lib/services/libcrmservice_la-services.ci".  The same source file
-    # could also exist in multiple directories.
-    #
-    # So, we need to find a callgraph file that ends with the same filename, but also
-    # exists in the right subdirectory.  The presence of the compiled object in the file
-    # name makes this all more annoying than it needs to be.
-
     # Split the directory off from the file.
     (filePath, fileFileName) = os.path.split(file_name)
 
-    for f in callgraphs:
-        # Split the directory off from the callgraph file.
-        (cgPath, cgFileName) = os.path.split(f)
+    # Strip the extension off the file's name.
+    (fileBase, _) = os.path.splitext(fileFileName)
 
-        # If the directories don't match, try the next.
-        if filePath != cgPath:
-            continue
+    return index.get((filePath, fileBase))
 
-        # Strip the extension off the file's name.
-        (fileBase, _) = os.path.splitext(fileFileName)
+def init_worker(ctx):
+    """ Set up the global context in a worker process """
 
-        # If the callgraph file ends with the file (minus extension), we've
-        # found a match
-        if cgFileName.endswith("-%s.ci" % fileBase):
-            return f
+    global context
+    context = ctx
 
-    return None
+def process_record(lines):
+    """ Given the lines of a single record, figure out which functions need their
+        coverage data removed and return the rewritten record as a string.  If
+        the record should be left out of the output entirely, return None.
+    """
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2 or not os.path.isfile(sys.argv[1]):
-        print("usage: %s <coverage_file.info>" % sys.argv[0])
-        sys.exit()
+    r = Record(lines)
+    file_name = remove_source_dir(r.source_file)
+    fns = r.fn_ranges
+    public_tested_fns = [f for f in fns if f.name in context.tested and f.name not in context.static]
 
-    tested = tested_fns()
-    static = static_fns()
-    records = recordize_info_file()
+    cg = find_callgraph_file(context.callgraphs, file_name)
+    if not cg:
+        return None
 
-    callgraphs = callgraph_files()
+    cg = build_call_graph(cg)
 
-    for r in records:
-        file_name = remove_source_dir(source_file(r))
-        fns = fns_in_record(r)
-        public_tested_fns = [f for f in fns if f.name in tested and not is_static_fn(static, f.name)]
+    # First figure out which functions need their coverage data removed,
+    # then rewrite the record in a single pass.
+    erased = []
 
-        cg = find_callgraph_file(callgraphs, file_name)
-        if not cg:
+    for fr in fns:
+        # If the function wasn't executed, there's nothing to do.
+        if not fn_executed(r, fr.name):
             continue
 
-        cg = build_call_graph(cg)
+        # If this is a private function with a public version we have a test
+        # for, it's likely the private function does all the hard work and
+        # the public test does a good enough job testing it.
+        if fr.name in context.tested_private:
+            # Add the private function to the list of tested functions in case
+            # it calls some static function.  This ensures that static function
+            # also gets its coverage counted.
+            public_tested_fns.append(fr)
+            continue
 
-        for fr in fns:
-            # If the function wasn't executed, there's nothing to do.
-            if not fn_executed(r, fr.name):
-                continue
+        # If the function is static, we won't be writing a unit test for it.
+        # If no tested public function in this record calls it (we can stick
+        # to just checking this record because it's static), remove its
+        # coverage data.  Otherwise, leave its coverage alone.
+        if fr.name in context.static:
+            if nothing_calls_fn(cg, public_tested_fns, fr.name):
+                erased.append(fr)
 
-            # If this is a private function with a public version we have a test
-            # for, it's likely the private function does all the hard work and
-            # the public test does a good enough job testing it.
-            if private_fn_with_tested_public(tested, fr.name):
-                # Add the private function to the list of tested functions in case
-                # it calls some static function.  This ensures that static function
-                # also gets its coverage counted.
-                public_tested_fns.append(fr)
-                continue
+            continue
 
-            # If the function is static, we won't be writing a unit test for it.
-            # If no tested public function in this record calls it (we can stick
-            # to just checking this record because it's static), remove its
-            # coverage data.  Otherwise, leave its coverage alone.
-            if is_static_fn(static, fr.name):
-                if nothing_calls_fn(cg, public_tested_fns, fr.name):
-                    r = erase_function_from_record(r, fr)
+        # The executed public function is not in the list of functions that
+        # we have a unit test for.  Remove its coverage data.
+        if fr.name not in context.tested:
+            erased.append(fr)
 
-                continue
+    return render_record(r, erased)
+
+def process_records(records):
+    """ Process a list of records, returning a list of the rewritten records
+        that should be printed.
+    """
+
+    return [rendered for rendered in map(process_record, records) if rendered is not None]
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or not os.path.isfile(sys.argv[1]):
+        print("usage: %s <coverage_file.info>" % sys.argv[0])
+        sys.exit()
+
+    tree = scan_tree()
+    tested = tested_fns(tree.test_files)
+    ctx = Context(tested, static_fns(tree.lib_files), private_fns_with_tested_public(tested),
+                  index_callgraph_files(tree.callgraph_files))
+
+    # Write to stdout through a large buffer, and only every so many records.
+    # There can be a lot of records, and writing each one separately is slow.
+    out = open(sys.stdout.fileno(), "w", encoding="utf-8", buffering=1<<20, closefd=False)
+    buf = []
+
+    # Each record can be processed independently, so farm them out in chunks to a
+    # pool of worker processes.  Executor.map would read the entire coverage file
+    # in before handing out any work, so instead keep only a limited number of
+    # chunks in flight and collect the results in order as they finish.
+    workers = os.cpu_count() or 1
+    records = iter_records(sys.argv[1])
+    pending = deque()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(ctx,)) as executor:
+        while True:
+            chunk = list(islice(records, RECORD_CHUNK_SIZE))
+            if chunk:
+                pending.append(executor.submit(process_records, chunk))
+
+                if len(pending) < 2 * workers:
+                    continue
+
+            if not pending:
+                break
+
+            buf.extend(pending.popleft().result())
 
-            # The executed public function is not in the list of functions that
-            # we have a unit test for.  Remove its coverage data.
-            if fr.name not in tested:
-                r = erase_function_from_record(r, fr)
+            if len(buf) >= WRITE_BATCH_SIZE:
+                out.write("".join(buf))
+                buf = []
 
-        print(render_record(r))
+    out.write("".join(buf))
+    out.close()